@@ -0,0 +1,649 @@
+"""
+Offline benchmark suite for the scripts in this repo.
+
+Runs each script's core loop against local stand-ins so throughput can be measured without VPN,
+AWS, postgres or gs-app access:
+- boto3: in-process fake s3/sqs/secretsmanager clients
+- database_model: sqlalchemy sessions on a throwaway sqlite database
+- gs_api_sdk, gs_common and the intake celery tasks: in-process fakes
+
+Every call made to a stand-in is counted, and can be slowed down or made to fail with the
+--latency and --error_rate flags. For each script and input size it reports rows/sec,
+calls made and peak (python) memory. Results can be saved with --output and compared against
+a previous revision's results with --compare.
+
+Most scripts don't handle errors from the services they call, so an injected error stops them like it
+would in production: the run is reported with its error, the seconds and calls made before it stopped,
+and no rows/sec. Use --error_calls to only inject errors where a script handles them, ex: s3.put_object
+for ingest_load_test or db.execute for update_intake_storage_path.
+
+Run time:
+The sqlite stand-in skips fsync (synchronous=OFF, journal_mode=MEMORY), so the scripts that commit once per
+row (reingest_uploads, update_intake_storage_path) mostly measure their own sqlalchemy overhead, around
+1.5k rows/sec with --skip_memory. Tracing memory slows every script down roughly 3-4x, so those two take about
+10 minutes at 1M rows with --skip_memory and closer to an hour without it. Use smaller --sizes for quick
+comparisons.
+
+Arguments:
+- scripts: scripts to benchmark (defaults to all of them)
+- sizes: number of input rows to benchmark each script at (defaults to 1k, 100k and 1M)
+- latency: seconds of latency added to every call made to a stand-in
+- error_rate: chance (0 to 1) that a call made to a stand-in raises an error
+- error_calls: only inject errors into these stand-in calls, ex: s3.put_object (defaults to all of them)
+- seed: random seed used for injected errors and the scripts' own randomness
+- skip_memory: don't trace memory, tracing slows the scripts down
+- output: path to write the results to as json
+- compare: path to results json from a previous run to compare against, the run must use the same
+  latency, error_rate, error_calls, skip_memory and seed
+
+Example:
+python benchmark_scripts.py --sizes 1000 100000 --output before.json
+(check out another revision)
+python benchmark_scripts.py --sizes 1000 100000 --compare before.json
+
+Requirements:
+- pip install sqlalchemy (only for the scripts that use database_model)
+"""
+
+import argparse
+import builtins
+import contextlib
+import csv
+import hashlib
+import json
+import os
+import random
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from collections import Counter
+
+try:
+    import sqlalchemy
+    from sqlalchemy import Column, Integer, String
+    from sqlalchemy.orm import declarative_base, sessionmaker
+except ImportError:
+    sqlalchemy = None
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [1000, 100000, 1000000]
+
+# Settings that change the measurements, runs can only be compared when these match.
+COMPARED_SETTINGS = ["latency", "error_rate", "error_calls", "skip_memory", "seed"]
+
+# The scripts sleep between batches, keep the real sleep around for injected latency.
+REAL_SLEEP = time.sleep
+
+
+class FakeServiceError(Exception):
+    """Raised by a stand-in when an error is injected."""
+
+
+class CallTracker:
+    """
+    Counts the calls made to the stand-ins and injects latency and errors into them
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None, error_calls=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_calls = error_calls
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = 0
+
+    def record(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            REAL_SLEEP(self.latency)
+        if self.error_calls is not None and name not in self.error_calls:
+            return
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            raise FakeServiceError(f"Injected error in {name}")
+
+
+class FakeS3Client:
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def put_object(self, Body, Bucket, Key):
+        self.tracker.record("s3.put_object")
+        # Read the body like boto3 would, but don't keep it around. ingest_load_test opens a file per upload
+        # and never closes it, so close it here to keep handles from piling up over big runs.
+        if hasattr(Body, "read"):
+            Body.read()
+            Body.close()
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def copy(self, CopySource, Bucket, Key):
+        self.tracker.record("s3.copy")
+
+
+class FakeS3Resource:
+    def __init__(self, tracker):
+        self.meta = types.SimpleNamespace(client=FakeS3Client(tracker))
+
+
+class FakeSQSClient:
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.tracker.record("sqs.send_message")
+        return {
+            "MessageId": str(self.tracker.calls["sqs.send_message"]),
+            "ResponseMetadata": {"HTTPStatusCode": 200}
+        }
+
+
+class FakeSecretsManagerClient:
+    def __init__(self, tracker, secrets):
+        self.tracker = tracker
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId):
+        self.tracker.record("secretsmanager.get_secret_value")
+        return {
+            "SecretString": self.secrets[SecretId],
+            "ResponseMetadata": {"HTTPStatusCode": 200}
+        }
+
+
+class FakeGsApiSdk:
+    """
+    Stand-in for gs_api_sdk.SDK
+    """
+
+    def __init__(self, tracker, host=None, service_name=None):
+        self.tracker = tracker
+        self.files = types.SimpleNamespace(find_by_id=self.find_file_by_id)
+
+    def login(self, username, password):
+        self.tracker.record("gs_api_sdk.login")
+
+    def find_file_by_id(self, file_id):
+        self.tracker.record("gs_api_sdk.files.find_by_id")
+        return {
+            "data": {
+                "s3Key": f"files/{file_id}.pdf",
+                "s3Bucket": "groundspeed-bench-files"
+            }
+        }
+
+
+class FakeCeleryTask:
+    """
+    Stand-in for a celery task, only supports task.s(...).apply_async(...)
+    """
+
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+
+    def s(self, *args, **kwargs):
+        return self
+
+    def apply_async(self, *args, **kwargs):
+        self.tracker.record(f"celery.{self.name}.apply_async")
+
+
+def fake_hash(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest().encode("utf-8")
+
+
+class FakeCryptoManager:
+    """
+    Stand-in for gs_common.config.cryptography_manager.CryptoManager
+    """
+
+    def __init__(self, tracker, service_name, stage):
+        self.tracker = tracker
+
+    def hash(self, salt_name, value):
+        self.tracker.record("crypto.hash")
+        return fake_hash(value)
+
+
+if sqlalchemy is not None:
+    Base = declarative_base()
+
+    class Agency(Base):
+        __tablename__ = "agency"
+
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    class AgencyConfiguration(Base):
+        __tablename__ = "agency_configuration"
+
+        id = Column(Integer, primary_key=True)
+        agency_id = Column(Integer)
+        hashed_api_key = Column(String, index=True)
+        intake_storage_path = Column(String)
+        orchestration_path = Column(String)
+        default_project_id = Column(String)
+
+    class Upload(Base):
+        __tablename__ = "upload"
+
+        id = Column(Integer, primary_key=True)
+        agency_configuration_id = Column(Integer)
+        status_code = Column(String)
+
+
+class Sandbox:
+    """
+    Working directory, stand-ins and (optionally) sqlite database for a single benchmark run
+    """
+
+    def __init__(self, work_dir, tracker):
+        self.work_dir = work_dir
+        self.tracker = tracker
+        self.secrets = {}
+        self.engine = None
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def create_database(self):
+        if sqlalchemy is None:
+            raise RuntimeError("sqlalchemy is required to benchmark scripts that use database_model")
+        self.engine = sqlalchemy.create_engine(f"sqlite:///{self.path('bench.db')}")
+
+        # The scripts commit once per row, skip fsyncing so sqlite's commit cost doesn't swamp the script.
+        def set_pragmas(connection, connection_record):
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA synchronous=OFF")
+            cursor.execute("PRAGMA journal_mode=MEMORY")
+            cursor.close()
+
+        sqlalchemy.event.listen(self.engine, "connect", set_pragmas)
+        Base.metadata.create_all(self.engine)
+
+    def insert_rows(self, table, rows, chunk_size=10000):
+        # Insert in chunks so seeding big inputs doesn't blow up memory.
+        chunk = []
+        with self.engine.begin() as connection:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    connection.execute(table.__table__.insert(), chunk)
+                    chunk = []
+            if chunk:
+                connection.execute(table.__table__.insert(), chunk)
+
+    def track_database_calls(self):
+        def before_cursor_execute(*args, **kwargs):
+            self.tracker.record("db.execute")
+
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+
+    def fake_modules(self):
+        """
+        Builds the modules the scripts import, keyed by module name
+        """
+        tracker = self.tracker
+        clients = {
+            "s3": lambda: FakeS3Client(tracker),
+            "sqs": lambda: FakeSQSClient(tracker),
+            "secretsmanager": lambda: FakeSecretsManagerClient(tracker, self.secrets),
+        }
+
+        modules = {
+            "boto3": make_module(
+                "boto3",
+                client=lambda service_name, **kwargs: clients[service_name](),
+                resource=lambda service_name, **kwargs: FakeS3Resource(tracker)),
+            "gs_api_sdk": make_module(
+                "gs_api_sdk",
+                SDK=lambda **kwargs: FakeGsApiSdk(tracker, **kwargs)),
+            "intake": make_module("intake"),
+            "intake.celery_tasks": make_module(
+                "intake.celery_tasks",
+                ingest_file=FakeCeleryTask(tracker, "ingest_file")),
+            "gs_common": make_module("gs_common"),
+            "gs_common.config": make_module("gs_common.config"),
+            "gs_common.config.cryptography_manager": make_module(
+                "gs_common.config.cryptography_manager",
+                CryptoManager=lambda *args: FakeCryptoManager(tracker, *args)),
+        }
+
+        if self.engine is not None:
+            Session = sessionmaker(bind=self.engine)
+
+            @contextlib.contextmanager
+            def session_scope():
+                session = Session()
+                try:
+                    yield session
+                    session.commit()
+                except Exception:
+                    session.rollback()
+                    raise
+                finally:
+                    session.close()
+
+            modules["database_model"] = make_module("database_model")
+            modules["database_model.db"] = make_module("database_model.db", session_scope=session_scope)
+            modules["database_model.schemas"] = make_module(
+                "database_model.schemas",
+                Agency=Agency,
+                AgencyConfiguration=AgencyConfiguration,
+                Upload=Upload)
+
+        return modules
+
+
+def make_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def write_csv(path, fieldnames, rows, header=True):
+    with open(path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def setup_ingest_load_test(sandbox, rows):
+    """
+    Every iteration uploads 10 accounts, so run rows / 10 iterations
+    """
+    account_path = sandbox.path("intake_accounts")
+    os.mkdir(account_path)
+    for name in ["pdf_lite_LT.zip", "pdf_heavy_LT.zip", "broad_LT.zip"]:
+        with open(os.path.join(account_path, name), "wb") as f:
+            f.write(os.urandom(4096))
+
+    sandbox.create_database()
+    sandbox.insert_rows(AgencyConfiguration, [
+        {"id": configuration_id, "intake_storage_path": f"load_test_{configuration_id}/inbound"}
+        for configuration_id in [190, 851]
+    ])
+
+    return {
+        "argv": ["--account_timeout", "0", "--ingest_timeout", "0", "--version", "2",
+                 "--iterations", str(max(rows // 10, 1)), "--intake_account_path", account_path],
+        "input": ["dev"],
+    }
+
+
+def setup_kick_off_ingestion(sandbox, rows):
+    """
+    Writes output.csv to the working directory, every 10th account already has OCR done
+    """
+    write_csv(sandbox.path("output.csv"), ["account", "path_to_file", "OCR_DONE"], (
+        {
+            "account": f"account_{i}",
+            "path_to_file": f"Travelers/account_{i}.zip",
+            "OCR_DONE": "TRUE" if i % 10 == 0 else "FALSE"
+        }
+        for i in range(rows)
+    ))
+
+    return {}
+
+
+def setup_kick_off_ocr(sandbox, rows):
+    input_path = sandbox.path("file_ids.csv")
+    write_csv(input_path, ["file_id"], ({"file_id": f"file_{i}"} for i in range(rows)), header=False)
+
+    return {
+        "argv": ["--input", input_path, "--username", "bench", "--password", "bench",
+                 "--hostname", "localhost"],
+    }
+
+
+def setup_reingest_uploads(sandbox, rows, configurations=10):
+    """
+    Uploads are spread over a handful of agency configurations, half of them sftp and half api
+    """
+    sandbox.create_database()
+    sandbox.insert_rows(Agency, [
+        {"id": i, "name": f"agency_{i}"} for i in range(1, configurations + 1)
+    ])
+    sandbox.insert_rows(AgencyConfiguration, [
+        {
+            "id": i,
+            "agency_id": i,
+            "hashed_api_key": fake_hash(f"api_key_{i}").decode("utf-8"),
+            "intake_storage_path": f"agency_{i}/inbound",
+            "orchestration_path": f"agency_{i}/orchestration",
+            "default_project_id": f"project_{i}"
+        }
+        for i in range(1, configurations + 1)
+    ])
+    sandbox.insert_rows(Upload, (
+        {"id": i, "agency_configuration_id": i % configurations + 1, "status_code": "Failed"}
+        for i in range(1, rows + 1)
+    ))
+
+    uploads_path = sandbox.path("uploads.csv")
+    fieldnames = ["id", "agency_configuration_id", "intake_method", "file_s3_path", "original_file_name"]
+    write_csv(uploads_path, fieldnames, (
+        {
+            "id": i,
+            "agency_configuration_id": i % configurations + 1,
+            "intake_method": "sftp" if i % 2 else "api",
+            "file_s3_path": f"orchestration/upload_{i}.zip",
+            "original_file_name": f"upload_{i}.zip"
+        }
+        for i in range(1, rows + 1)
+    ))
+
+    return {
+        "argv": ["--uploads_path", uploads_path, "--remove_orch_path"],
+        "env": {"STAGE": "local"},
+    }
+
+
+def setup_update_intake_storage_path(sandbox, rows):
+    """
+    Every api key in the secret has a matching agency configuration
+    """
+    sandbox.create_database()
+    sandbox.insert_rows(AgencyConfiguration, (
+        {"id": i, "hashed_api_key": fake_hash(f"api_key_{i}").decode("utf-8")}
+        for i in range(1, rows + 1)
+    ))
+    sandbox.secrets["dev-intake-sftp-api-key-lookup"] = json.dumps({
+        f"groundspeed.client_{i}": f"api_key_{i}" for i in range(1, rows + 1)
+    })
+
+    return {
+        "env": {"STAGE": "dev"},
+    }
+
+
+# Script file -> function that prepares its inputs and stand-ins for a number of rows.
+SCENARIOS = {
+    "ingest_load_test.py": setup_ingest_load_test,
+    "kick_off_ingestion.py": setup_kick_off_ingestion,
+    "kick_off_ocr.py": setup_kick_off_ocr,
+    "reingest_uploads.py": setup_reingest_uploads,
+    "update_intake_storage_path.py": setup_update_intake_storage_path,
+}
+
+
+@contextlib.contextmanager
+def patched_environment(sandbox, scenario):
+    """
+    Points the script at the sandbox: argv, env vars, prompts, sleeps, cwd and imported modules
+    """
+    answers = iter(scenario.get("input", []))
+    fake_modules = sandbox.fake_modules()
+    saved_modules = {name: sys.modules.get(name) for name in fake_modules}
+    saved_env = {name: os.environ.get(name) for name in scenario.get("env", {})}
+    saved = (sys.argv, builtins.input, time.sleep, os.getcwd())
+
+    sys.argv = ["script"] + scenario.get("argv", [])
+    builtins.input = lambda prompt="": next(answers)
+    time.sleep = lambda seconds: None
+    os.chdir(sandbox.work_dir)
+    os.environ.update(scenario.get("env", {}))
+    sys.modules.update(fake_modules)
+    try:
+        yield
+    finally:
+        sys.argv, builtins.input, time.sleep, cwd = saved
+        os.chdir(cwd)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        for name, module in saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+def run_benchmark(script, rows, latency=0.0, error_rate=0.0, seed=None, trace_memory=True, error_calls=None):
+    """
+    Runs a single script against the stand-ins and returns its measurements
+    """
+    tracker = CallTracker(latency, error_rate, seed, error_calls)
+    result = {"script": script, "rows": rows}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        sandbox = Sandbox(work_dir, tracker)
+        try:
+            scenario = SCENARIOS[script](sandbox, rows)
+        except RuntimeError as e:
+            result.update({"error": f"skipped: {e}", "rows_per_sec": None})
+            return result
+
+        if sandbox.engine is not None:
+            sandbox.track_database_calls()
+
+        random.seed(seed)
+        if trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        try:
+            # Send the scripts' output to devnull, buffering it would count towards peak memory.
+            with patched_environment(sandbox, scenario), open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                runpy.run_path(os.path.join(SCRIPTS_DIR, script), run_name="__main__")
+        except (Exception, SystemExit) as e:
+            result["error"] = repr(e)
+        time_elapsed = time.perf_counter() - start_time
+        if trace_memory:
+            result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        if sandbox.engine is not None:
+            sandbox.engine.dispose()
+
+    result["seconds"] = time_elapsed
+    result["rows_per_sec"] = None if "error" in result else rows / time_elapsed
+    result["calls"] = dict(tracker.calls)
+    result["total_calls"] = sum(tracker.calls.values())
+    result["injected_errors"] = tracker.errors
+    return result
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIR, stderr=subprocess.DEVNULL
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_number(value, spec):
+    return "n/a" if value is None else format(value, spec)
+
+
+def print_report(results, previous=None):
+    previous_results = {}
+    if previous:
+        previous_results = {(r["script"], r["rows"]): r for r in previous["results"]}
+
+    header = f"{'script':<32}{'rows':>10}{'rows/sec':>14}{'calls':>12}{'errors':>8}{'peak MB':>10}"
+    if previous:
+        header += f"{'vs ' + str(previous.get('revision')):>18}"
+    print(header)
+
+    for result in results:
+        rows_per_sec = result["rows_per_sec"]
+        peak_memory = result.get("peak_memory_mb")
+        line = (
+            f"{result['script']:<32}{result['rows']:>10}"
+            f"{format_number(rows_per_sec, '.1f'):>14}"
+            f"{result.get('total_calls', 0):>12}{result.get('injected_errors', 0):>8}"
+            f"{format_number(peak_memory, '.2f'):>10}"
+        )
+        before = previous_results.get((result["script"], result["rows"]), {}).get("rows_per_sec")
+        if previous:
+            if before and rows_per_sec is not None:
+                line += f"{(rows_per_sec - before) / before:>+18.1%}"
+            else:
+                line += f"{'n/a':>18}"
+        print(line)
+        if "error" in result and "seconds" in result:
+            print(f"    stopped after {result['seconds']:.2f} seconds: {result['error']}")
+        elif "error" in result:
+            print(f"    error: {result['error']}")
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scripts", help="Scripts to benchmark", nargs="+", choices=list(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument("--sizes", help="Number of input rows to benchmark at", nargs="+", type=int,
+                        default=DEFAULT_SIZES)
+    parser.add_argument("--latency", help="Seconds of latency added to each stand-in call", type=float,
+                        default=0.0)
+    parser.add_argument("--error_rate", help="Chance (0 to 1) of each stand-in call raising", type=float,
+                        default=0.0)
+    parser.add_argument("--error_calls", help="Stand-in calls to inject errors into, ex: s3.put_object",
+                        nargs="+", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip_memory", help="Don't trace peak memory", action="store_true", default=False)
+    parser.add_argument("--output", help="Path to write results json", type=str, default=None)
+    parser.add_argument("--compare", help="Path to results json from a previous run", type=str, default=None)
+    args = parser.parse_args()
+
+    settings = {name: getattr(args, name) for name in COMPARED_SETTINGS}
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+        different_settings = [
+            f"{name} (previous: {previous.get(name)}, now: {value})"
+            for name, value in settings.items() if previous.get(name) != value
+        ]
+        if different_settings:
+            print(f"Can't compare against {args.compare}, settings differ: {', '.join(different_settings)}")
+            return
+
+    results = []
+    for script in args.scripts:
+        for rows in args.sizes:
+            print(f"-- Benchmarking {script} with {rows} rows --", file=sys.stderr)
+            results.append(run_benchmark(script, rows, args.latency, args.error_rate, args.seed,
+                                         trace_memory=not args.skip_memory, error_calls=args.error_calls))
+
+    print_report(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"revision": get_revision(), **settings, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    # Do the thang.
+    run()